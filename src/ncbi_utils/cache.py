@@ -1,33 +1,229 @@
 import gzip
+import json
+import math
+import mmap
+import os
 import pickle
 import hashlib
+import tempfile
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 def hash_from_tuple(tuple_):
-    str_tuple = tuple(map(str, tuple_))
-    return hashlib.md5(" ".join(str_tuple).encode()).hexdigest()
+    hasher = hashlib.blake2b(digest_size=16)
+    for item in tuple_:
+        hasher.update(str(item).encode())
+        hasher.update(b"\x00")
+    return hasher.hexdigest()
 
 
 class MissingCachedResult(RuntimeError):
     pass
 
 
-def save_cache(value_, cache_path, use_gzip=False):
+# Every cached payload starts with a one byte tag telling how the rest was
+# serialized. Files written before the tags existed are plain pickles, and
+# those always start with the pickle PROTO opcode.
+_BYTES_TAG = b"B"
+_JSON_TAG = b"J"
+_PICKLE_TAG = b"P"
+_PICKLE_PROTO_OPCODE = b"\x80"
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_MAGIC_LEN = max(len(_GZIP_MAGIC), len(_ZSTD_MAGIC))
+COMPRESSIONS = (None, "gzip", "zstd")
+EXTENSIONS = {None: "pickle", "gzip": "pickle.gz", "zstd": "pickle.zst"}
+
+CONTENT_DIR_NAME = "by-content"
+
+# mkstemp creates 0600 files, cache files get the mode open() would give them
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+_FILE_MODE = 0o666 & ~_UMASK
+
+_ENSURED_DIRS = set()
+_DIR_LISTINGS = {}
+
+
+def _ensure_dir(dir_path):
+    if dir_path not in _ENSURED_DIRS:
+        dir_path.mkdir(exist_ok=True)
+        _ENSURED_DIRS.add(dir_path)
+
+
+def _list_dir(dir_path):
+    if dir_path not in _DIR_LISTINGS:
+        try:
+            _DIR_LISTINGS[dir_path] = set(os.listdir(dir_path))
+        except FileNotFoundError:
+            _DIR_LISTINGS[dir_path] = set()
+    return _DIR_LISTINGS[dir_path]
+
+
+def _is_cached(cache_path):
+    return cache_path.name in _list_dir(cache_path.parent)
+
+
+def _json_dumps(value_):
+    if orjson is not None:
+        return orjson.dumps(value_)
+    return json.dumps(value_).encode()
+
+
+def _json_loads(content):
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(bytes(content))
+
+
+def _survives_json(value_):
+    # only values that JSON gives back unchanged, so no tuples, sets,
+    # non-str keys, subclasses or non-finite floats
+    type_ = type(value_)
+    if type_ in (str, int, bool) or value_ is None:
+        return True
+    if type_ is float:
+        return math.isfinite(value_)
+    if type_ is list:
+        return all(_survives_json(item) for item in value_)
+    if type_ is dict:
+        return all(
+            type(key) is str and _survives_json(item) for key, item in value_.items()
+        )
+    return False
+
+
+def _serialize(value_):
+    if isinstance(value_, bytes):
+        return _BYTES_TAG, value_
+    if type(value_) in (dict, list) and _survives_json(value_):
+        try:
+            return _JSON_TAG, _json_dumps(value_)
+        except (TypeError, ValueError):
+            # e.g. orjson refuses integers wider than 64 bits
+            pass
+    return _PICKLE_TAG, pickle.dumps(value_, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _deserialize(payload):
+    tag = bytes(payload[:1])
+    if tag == _PICKLE_PROTO_OPCODE:
+        return pickle.loads(payload)
+    # the slice is released even on errors, payload may be a mmap view
+    with memoryview(payload)[1:] as body:
+        if tag == _BYTES_TAG:
+            return bytes(body)
+        elif tag == _JSON_TAG:
+            return _json_loads(body)
+        elif tag == _PICKLE_TAG:
+            return pickle.loads(body)
+    raise RuntimeError(f"Unknown cache format, tag: {tag}")
+
+
+def _check_compression(compression, use_gzip):
     if use_gzip:
-        fhand = gzip.open(cache_path, "wb")
+        compression = "gzip"
+    if compression not in COMPRESSIONS:
+        raise ValueError(
+            f"compression should be one of {COMPRESSIONS}, but it was: {compression}"
+        )
+    if compression == "zstd" and zstandard is None:
+        raise RuntimeError("zstd compression requires the zstandard package")
+    return compression
+
+
+def _write_atomically(path, chunks):
+    fd, tmp_path = tempfile.mkstemp(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".tmp"
+    )
+    try:
+        with open(fd, "wb") as fhand:
+            for chunk in chunks:
+                fhand.write(chunk)
+        os.chmod(tmp_path, _FILE_MODE)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _deduplicate(cache_path, chunks):
+    hasher = hashlib.blake2b(digest_size=16)
+    for chunk in chunks:
+        hasher.update(chunk)
+    content_dir = cache_path.parent / CONTENT_DIR_NAME
+    _ensure_dir(content_dir)
+    content_path = content_dir / hasher.hexdigest()
+    try:
+        if _is_cached(content_path):
+            fd, tmp_path = tempfile.mkstemp(
+                dir=cache_path.parent, prefix=f".{cache_path.name}.", suffix=".tmp"
+            )
+            os.close(fd)
+            os.unlink(tmp_path)
+            os.link(content_path, tmp_path)
+            os.replace(tmp_path, cache_path)
+        else:
+            os.link(cache_path, content_path)
+            _list_dir(content_dir).add(content_path.name)
+    except OSError:
+        # without hard links, or with a stale listing, the plain copy is kept
+        pass
+
+
+def save_cache(
+    value_, cache_path, use_gzip=False, compression=None, deduplicate=False
+):
+    compression = _check_compression(compression, use_gzip)
+    tag, body = _serialize(value_)
+    if compression is None:
+        chunks = (tag, body)
     else:
-        fhand = open(cache_path, "wb")
-    pickle.dump(value_, fhand)
+        payload = tag + body
+        if compression == "gzip":
+            # no timestamp in the header, so identical values dedupe
+            payload = gzip.compress(payload, mtime=0)
+        elif compression == "zstd":
+            payload = zstandard.ZstdCompressor(level=3, threads=-1).compress(payload)
+        chunks = (payload,)
+    # files may share their inode with other cache entries, so they are
+    # always replaced, never rewritten in place
+    _write_atomically(cache_path, chunks)
+    _list_dir(cache_path.parent).add(cache_path.name)
+    if deduplicate:
+        _deduplicate(cache_path, chunks)
 
 
 def load_cache(cache_path):
-    if not cache_path.exists():
-        raise MissingCachedResult()
     try:
-        return pickle.load(gzip.open(cache_path, "rb"))
-    except gzip.BadGzipFile:
-        return pickle.load(open(cache_path, "rb"))
+        fhand = open(cache_path, "rb")
+    except FileNotFoundError:
+        raise MissingCachedResult()
+    with fhand:
+        magic = fhand.read(_MAGIC_LEN)
+        if not magic:
+            # an empty file holds no result, mmap would refuse it anyway
+            raise MissingCachedResult()
+        if magic.startswith(_GZIP_MAGIC):
+            fhand.seek(0)
+            return _deserialize(gzip.decompress(fhand.read()))
+        elif magic.startswith(_ZSTD_MAGIC):
+            _check_compression("zstd", use_gzip=False)
+            fhand.seek(0)
+            return _deserialize(zstandard.ZstdDecompressor().decompress(fhand.read()))
+        with mmap.mmap(fhand.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as payload:
+                return _deserialize(payload)
 
 
 def get_result(
@@ -37,9 +233,15 @@ def get_result(
     kwargs=None,
     use_gzip=False,
     update_cache=False,
+    compression=None,
+    deduplicate=False,
 ):
-    if not update_cache and cache_path.exists():
-        return load_cache(cache_path)
+    if not update_cache and _is_cached(cache_path):
+        try:
+            return load_cache(cache_path)
+        except MissingCachedResult:
+            # removed after the directory was listed
+            _list_dir(cache_path.parent).discard(cache_path.name)
 
     if args is None:
         args = tuple()
@@ -47,7 +249,13 @@ def get_result(
         kwargs = {}
 
     result = funct(*args, **kwargs)
-    save_cache(result, cache_path=cache_path, use_gzip=use_gzip)
+    save_cache(
+        result,
+        cache_path=cache_path,
+        use_gzip=use_gzip,
+        compression=compression,
+        deduplicate=deduplicate,
+    )
     return result
 
 
@@ -57,13 +265,16 @@ def get_cached_result_from_dir(
     args: tuple,
     update_cache=False,
     use_gzip=False,
+    compression=None,
+    deduplicate=False,
 ):
+    compression = _check_compression(compression, use_gzip)
     args = tuple(args)
     hash = hash_from_tuple(args)
 
-    cache_dir.mkdir(exist_ok=True)
+    _ensure_dir(cache_dir)
 
-    extension = "pickle.gz" if use_gzip else "pickle"
+    extension = EXTENSIONS[compression]
 
     cache_path = cache_dir / f"{funct.__name__}.{hash}.{extension}"
     result = get_result(
@@ -71,5 +282,7 @@ def get_cached_result_from_dir(
         cache_path=cache_path,
         args=args,
         update_cache=update_cache,
+        compression=compression,
+        deduplicate=deduplicate,
     )
     return result
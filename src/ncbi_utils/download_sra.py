@@ -1,12 +1,44 @@
+import os
+import shutil
 import tempfile
 from pathlib import Path
-from subprocess import run, CalledProcessError
+from subprocess import run
 
 PREFETCH_BIN = "prefetch"
 VALIDATE_BIN = "vdb-validate"
 FASTERQ_DUMP_BIN = "fasterq-dump"
-GZIP_BIN = "gzip"
-GZIP_BIN = "pigz"
+FASTERQ_DUMP_FIXED_ARGS = (
+    "--split-3",
+    "--skip-technical",
+    "--seq-defline",
+    r"@$ac.$si.$ri:$sg:$sn",
+)
+GZIP_BIN = shutil.which("pigz") or shutil.which("gzip")
+OUTPUT_TAIL_SIZE = 64 * 1024
+
+
+def _read_tail(path, size=OUTPUT_TAIL_SIZE):
+    with open(path, "rb") as fhand:
+        fhand.seek(0, os.SEEK_END)
+        fhand.seek(max(fhand.tell() - size, 0))
+        return fhand.read().decode(errors="replace")
+
+
+def _run(cmd, error_msg, log_dir: Path, verbose=False):
+    if verbose:
+        msg = "cmd: " + " ".join(cmd)
+        print(msg)
+    stdout_path = log_dir / f"{Path(cmd[0]).name}.stdout"
+    stderr_path = log_dir / f"{Path(cmd[0]).name}.stderr"
+    with stdout_path.open("wb") as stdout, stderr_path.open("wb") as stderr:
+        process = run(cmd, stdout=stdout, stderr=stderr)
+    if process.returncode or verbose:
+        msg = f"\nstdout:\n{_read_tail(stdout_path)}"
+        msg += f"\nstderr:\n{_read_tail(stderr_path)}"
+        if process.returncode:
+            msg = f"{error_msg}, the command was: " + " ".join(cmd) + msg
+            raise RuntimeError(msg)
+        print(msg)
 
 
 def download_fastq_from_sra(
@@ -14,9 +46,12 @@ def download_fastq_from_sra(
     out_dir,
     temp_dir: None | Path = None,
     fasterq_dump_num_threads=6,
-    max_dowload_size=30,
+    max_download_size=30,
     verbose=False,
 ):
+    if GZIP_BIN is None:
+        raise RuntimeError("Neither pigz nor gzip were found in the PATH")
+
     out_dir = Path(out_dir)
     if not out_dir.exists():
         raise ValueError(f"out_dir should exist: {out_dir}")
@@ -25,9 +60,10 @@ def download_fastq_from_sra(
             f"out_dir should be a directory, but the given one is not: {out_dir}"
         )
 
-    previous_downloaded_files = [
-        str(path) for path in out_dir.iterdir() if path.name.startswith(run_acc)
-    ]
+    with os.scandir(out_dir) as entries:
+        previous_downloaded_files = [
+            entry.path for entry in entries if entry.name.startswith(run_acc)
+        ]
     if previous_downloaded_files:
         msg = "There are previous downloaded files for this run: " + ",".join(
             previous_downloaded_files
@@ -41,83 +77,62 @@ def download_fastq_from_sra(
         cmd = [
             PREFETCH_BIN,
             "--max-size",
-            f"{max_dowload_size}g",
+            f"{max_download_size}g",
             "-O",
             str(working_dir_path),
             run_acc,
         ]
-        if verbose:
-            msg = "cmd: " + " ".join(cmd)
-            print(msg)
-        process = run(cmd, capture_output=True)
-        if process.returncode:
-            msg = (
-                f"There was an error prefetching the accession {run_acc}, the command was: "
-                + " ".join(cmd)
-            )
-            msg += f"\nstdout:\n{process.stdout.decode()}"
-            msg += f"\nstderr:\n{process.stderr.decode()}"
-            raise RuntimeError(msg)
-        if verbose:
-            msg = f"\nstdout:\n{process.stdout.decode()}"
-            msg += f"\nstderr:\n{process.stderr.decode()}"
-            print(msg)
+        _run(
+            cmd,
+            f"There was an error prefetching the accession {run_acc}",
+            log_dir=working_dir_path,
+            verbose=verbose,
+        )
 
         sra_dir = working_dir_path / run_acc
         cmd = [VALIDATE_BIN, str(sra_dir)]
-        if verbose:
-            msg = "cmd: " + " ".join(cmd)
-            print(msg)
-        process = run(cmd, capture_output=True)
-        if process.returncode:
-            msg = (
-                f"There was an error validating the prefetched accession {run_acc}, the command was: "
-                + " ".join(cmd)
-            )
-            msg += f"\nstdout:\n{process.stdout.decode()}"
-            msg += f"\nstderr:\n{process.stderr.decode()}"
-            raise RuntimeError(msg)
-        if verbose:
-            msg = f"\nstdout:\n{process.stdout.decode()}"
-            msg += f"\nstderr:\n{process.stderr.decode()}"
-            print(msg)
+        _run(
+            cmd,
+            f"There was an error validating the prefetched accession {run_acc}",
+            log_dir=working_dir_path,
+            verbose=verbose,
+        )
 
         fast_out_dir = working_dir_path / "fast"
 
-        cmd = [
+        cmd = (
             FASTERQ_DUMP_BIN,
             "--outdir",
             str(fast_out_dir),
             "--temp",
             str(working_dir_path),
-            "--split-3",
             "--threads",
             str(fasterq_dump_num_threads),
-            "--skip-technical",
-            "--seq-defline",
-            r"@$ac.$si.$ri:$sg:$sn",
+            *FASTERQ_DUMP_FIXED_ARGS,
             str(sra_dir),
-        ]
-        if verbose:
-            msg = "cmd: " + " ".join(cmd)
-            print(msg)
-        process = run(cmd, capture_output=True)
-        if process.returncode:
-            msg = (
-                f"There was an error doing fasterq_dump the accession {run_acc}, the command was: "
-                + " ".join(cmd)
-            )
-            msg += f"\nstdout:\n{process.stdout.decode()}"
-            msg += f"\nstderr:\n{process.stderr.decode()}"
-            raise RuntimeError(msg)
-        if verbose:
-            msg = f"\nstdout:\n{process.stdout.decode()}"
-            msg += f"\nstderr:\n{process.stderr.decode()}"
-            print(msg)
+        )
+        _run(
+            cmd,
+            f"There was an error doing fasterq_dump the accession {run_acc}",
+            log_dir=working_dir_path,
+            verbose=verbose,
+        )
 
-        for path in fast_out_dir.iterdir():
-            cmd = [GZIP_BIN, path]
-            run(cmd, check=True)
-        for path in fast_out_dir.iterdir():
-            cmd = ["mv", str(path), str(out_dir)]
-            run(cmd)
+        for fastq_path in sorted(fast_out_dir.iterdir()):
+            gz_path = out_dir / f"{fastq_path.name}.gz"
+            part_path = out_dir / f"{fastq_path.name}.gz.part"
+            cmd = [GZIP_BIN, "-c"]
+            if Path(GZIP_BIN).name == "pigz":
+                cmd.extend(["-p", str(fasterq_dump_num_threads)])
+            cmd.append(str(fastq_path))
+            if verbose:
+                msg = "cmd: " + " ".join(cmd) + " > " + str(part_path)
+                print(msg)
+            try:
+                with part_path.open("wb") as fhand:
+                    run(cmd, stdout=fhand, check=True)
+            except BaseException:
+                part_path.unlink(missing_ok=True)
+                raise
+            os.replace(part_path, gz_path)
+            fastq_path.unlink()
@@ -1,25 +1,279 @@
 import json
+import logging
+import os
 from pathlib import Path
 import pickle
+import pickletools
 import hashlib
+import io
+import threading
+import time
 import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import NewType
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ncbi_utils.cache import _write_atomically
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 NCBI_EUTILS_BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
 NCBI_SEARCH_BASE_URL = NCBI_EUTILS_BASE_URL + "esearch.fcgi?"
 NCBI_FETCH_BASE_URL = NCBI_EUTILS_BASE_URL + "efetch.fcgi?"
+NCBI_API_KEY = os.environ.get("NCBI_API_KEY")
+NCBI_MAX_REQUESTS_PER_SECOND = 10 if NCBI_API_KEY else 3
+REQUEST_TIMEOUT = 30
+EFETCH_BATCH_SIZE = 200
+MEMORY_CACHE_SIZE = 4096
+_SIMPLE_TYPES = (str, int, bool, type(None), float)
+
+# NCBI database ids, all digits (e.g. 1025377), as opposed to accessions
+NumericId = NewType("NumericId", str)
+
+_PLATFORM_NAMES = {
+    "ILLUMINA": "ilumina",
+    "DNBSEQ": "dnbseq",
+    "OXFORD_NANOPORE": "nanopore",
+    "PACBIO_SMRT": "pacbio",
+    "BGISEQ": "bgiseq",
+    "LS454": "454",
+    "ABI_SOLID": "solid",
+}
+
+EXPERIMENT_COLUMNS = (
+    "accession",
+    "bioproject",
+    "bioproject_title",
+    "bioproject_description",
+    "biosample_title",
+    "biosample_organism",
+    "biosample_cultivar",
+    "library_strategy",
+    "library_source",
+    "library_selection",
+    "platform",
+    "organization",
+    "study",
+    "date",
+    "is_public",
+)
+
+# (key, child tags to follow, attribute or None to take the text)
+_BIOPROJECT_FIELDS = (
+    ("acc", ("ProjectID", "ArchiveID"), "accession"),
+    ("title", ("ProjectDescr", "Title"), None),
+    ("description", ("ProjectDescr", "Description"), None),
+)
+_BIOSAMPLE_FIELDS = (
+    ("biosampledb_id", (), "id"),
+    ("biosampledb_accession", (), "accession"),
+    ("publication_date", (), "publication_date"),
+    ("title", ("Description", "Title"), None),
+    ("organism_id", ("Description", "Organism"), "taxonomy_id"),
+    ("organism_name", ("Description", "Organism"), "taxonomy_name"),
+)
+_EXPERIMENT_FIELDS = (
+    ("acc", ("IDENTIFIERS", "PRIMARY_ID"), None),
+    ("study_acc", ("STUDY_REF",), "accession"),
+)
+_DESIGN_FIELDS = (
+    ("description", ("DESIGN_DESCRIPTION",), None),
+    ("sample", ("SAMPLE_DESCRIPTOR",), "accession"),
+)
+_LIBRARY_FIELDS = (
+    ("strategy", ("LIBRARY_STRATEGY",), None),
+    ("source", ("LIBRARY_SOURCE",), None),
+    ("selection", ("LIBRARY_SELECTION",), None),
+    ("layout", ("LIBRARY_LAYOUT",), None),
+)
+_RUN_FIELDS = (
+    ("accession", (), "accession"),
+    ("date", (), "published"),
+    ("is_public", (), "is_public"),
+)
+_SRA_FILE_FIELDS = (
+    ("name", (), "filename"),
+    ("md5", (), "md5"),
+    ("s3_url", ("Alternatives",), "url"),
+)
+
+logger = logging.getLogger(__name__)
+
+_MEMORY_CACHE = OrderedDict()
+_MEMORY_CACHE_LOCK = threading.Lock()
+_FUNCT_CACHE_DIRS = {}
+_NOT_IN_MEMORY = object()
+
+_SESSION = requests.Session()
+_SESSION.headers.update(
+    {"Accept-Encoding": "gzip, deflate", "User-Agent": "ncbi_utils"}
+)
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=2 * NCBI_MAX_REQUESTS_PER_SECOND,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET", "POST"],
+        ),
+    ),
+)
+_REQUEST_SLOT_LOCK = threading.Lock()
+_last_request_time = 0.0
+
+
+def _wait_for_request_slot():
+    global _last_request_time
+    with _REQUEST_SLOT_LOCK:
+        wait = (
+            _last_request_time + 1 / NCBI_MAX_REQUESTS_PER_SECOND - time.monotonic()
+        )
+        if wait > 0:
+            time.sleep(wait)
+        _last_request_time = time.monotonic()
+
+
+def _get(url):
+    _wait_for_request_slot()
+    params = {"api_key": NCBI_API_KEY} if NCBI_API_KEY else None
+    return _SESSION.get(url, params=params, timeout=REQUEST_TIMEOUT)
+
+
+def _post(url, data, stream=False):
+    _wait_for_request_slot()
+    params = {"api_key": NCBI_API_KEY} if NCBI_API_KEY else None
+    return _SESSION.post(
+        url, data=data, params=params, timeout=REQUEST_TIMEOUT, stream=stream
+    )
+
+
+def _fetch_in_batches(db, ids):
+    url = f"{NCBI_EUTILS_BASE_URL}efetch.fcgi"
+    for start in range(0, len(ids), EFETCH_BATCH_SIZE):
+        batch = ids[start : start + EFETCH_BATCH_SIZE]
+        response = _post(url, data={"db": db, "id": ",".join(batch)}, stream=True)
+        with response:
+            if response.status_code != 200:
+                raise RuntimeError(f"There was a problem fetching {db} ids: {batch}")
+            # the body is parsed while it is still being received
+            response.raw.decode_content = True
+            yield response.raw
+
+
+def _validate_numeric(id_: str) -> NumericId:
+    if not id_.isdecimal():
+        raise ValueError(
+            f"Use the numeric id (e.g. 1025377), not the accession, but it was: {id_}"
+        )
+    return NumericId(id_)
+
+
+def _get_fields(element, fields):
+    values = {}
+    for key, tags, attr in fields:
+        target = element
+        for tag in tags:
+            target = target.find(tag)
+        values[key] = target.text if attr is None else target.attrib[attr]
+    return values
+
+
+def _parse_json(content):
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
 
 
-def _hash(value):
+def _get_json(url):
+    response = _get(url)
+    if response.status_code != 200:
+        raise RuntimeError(f"There was a problem getting the URL: {url}")
+    return _parse_json(response.content)
+
+
+def _update_hash(hasher, value):
     try:
         hash(value)
     except TypeError:
         raise ValueError(
             "All arguments should be hasheable, but this one failed: " + str(value)
         )
-    pickled = pickle.dumps(value)
-    return hashlib.md5(pickled).hexdigest()
+    if isinstance(value, _SIMPLE_TYPES):
+        kind, encoded = b"s", f"{type(value).__name__}:{value}".encode()
+    elif isinstance(value, tuple) and all(
+        isinstance(item, _SIMPLE_TYPES) for item in value
+    ):
+        hasher.update(b"t" + len(value).to_bytes(8, "little"))
+        for item in value:
+            _update_hash(hasher, item)
+        return
+    else:
+        kind, encoded = b"p", pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    hasher.update(kind + len(encoded).to_bytes(8, "little"))
+    hasher.update(encoded)
+
+
+def _hash_args(args, kwargs):
+    hasher = hashlib.blake2b(digest_size=16)
+    for arg in args:
+        _update_hash(hasher, arg)
+    hasher.update(b"\x01")
+    for item in sorted(kwargs.items()):
+        _update_hash(hasher, item)
+    return hasher.hexdigest()
+
+
+def _get_from_memory(cache_path):
+    with _MEMORY_CACHE_LOCK:
+        if cache_path not in _MEMORY_CACHE:
+            return _NOT_IN_MEMORY
+        logger.debug("memory cache hit: %s", cache_path)
+        _MEMORY_CACHE.move_to_end(cache_path)
+        return _MEMORY_CACHE[cache_path]
+
+
+def _keep_in_memory(cache_path, result):
+    with _MEMORY_CACHE_LOCK:
+        _MEMORY_CACHE[cache_path] = result
+        if len(_MEMORY_CACHE) > MEMORY_CACHE_SIZE:
+            _MEMORY_CACHE.popitem(last=False)
+
+
+def _get_funct_cache_dir(funct, cache_dir):
+    key = (cache_dir, funct.__name__)
+    funct_cache_dir = _FUNCT_CACHE_DIRS.get(key)
+    if funct_cache_dir is None:
+        funct_cache_dir = cache_dir / funct.__name__
+        funct_cache_dir.mkdir(parents=True, exist_ok=True)
+        _FUNCT_CACHE_DIRS[key] = funct_cache_dir
+    return funct_cache_dir
+
+
+def _load_from_disk(cache_path):
+    with cache_path.open("rb") as fhand:
+        result = pickle.load(fhand)
+    logger.debug("disk cache hit: %s", cache_path)
+    _keep_in_memory(cache_path, result)
+    return result
+
+
+def _call_and_save(funct, cache_path, args, kwargs):
+    logger.debug("cache miss: %s", cache_path)
+    result = funct(*args, **kwargs)
+    pickled = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+    _write_atomically(cache_path, (pickletools.optimize(pickled),))
+    _keep_in_memory(cache_path, result)
+    return result
 
 
 def cache_call(funct, cache_dir: Path, args=None, kwargs=None):
@@ -28,34 +282,58 @@ def cache_call(funct, cache_dir: Path, args=None, kwargs=None):
     if kwargs is None:
         kwargs = {}
 
-    hashes = [_hash(arg) for arg in args]
-    hashes.extend((_hash(kwargs[arg]) for arg in sorted(kwargs.keys())))
+    hash_ = _hash_args(args, kwargs)
+    cache_path = _get_funct_cache_dir(funct, cache_dir) / hash_
+    result = _get_from_memory(cache_path)
+    if result is not _NOT_IN_MEMORY:
+        return result
 
-    hash_ = _hash(tuple(hashes))
-    cache_dir.mkdir(exist_ok=True)
-    cache_dir = cache_dir / funct.__name__
-    cache_dir.mkdir(exist_ok=True)
-    cache_path = cache_dir / str(hash_)
-    if cache_path.exists():
-        with cache_path.open("rb") as fhand:
-            result = pickle.load(fhand)
-    else:
-        result = funct(*args, **kwargs)
-        with cache_path.open("wb") as fhand:
-            pickle.dump(result, fhand)
-    return result
+    try:
+        return _load_from_disk(cache_path)
+    except FileNotFoundError:
+        return _call_and_save(funct, cache_path, args, kwargs)
+
+
+def cache_call_many(funct, cache_dir: Path, args_list, max_workers=8):
+    args_list = [tuple(args) for args in args_list]
+    funct_cache_dir = _get_funct_cache_dir(funct, cache_dir)
+    with os.scandir(funct_cache_dir) as entries:
+        cached_names = {entry.name for entry in entries}
+
+    cache_paths = [funct_cache_dir / _hash_args(args, {}) for args in args_list]
+    results = [_get_from_memory(cache_path) for cache_path in cache_paths]
+    on_disk = [
+        idx
+        for idx, result in enumerate(results)
+        if result is _NOT_IN_MEMORY and cache_paths[idx].name in cached_names
+    ]
+
+    def load(idx):
+        try:
+            return _load_from_disk(cache_paths[idx])
+        except FileNotFoundError:
+            # removed after the listing, it is recomputed with the misses
+            return _NOT_IN_MEMORY
 
+    # only the disk loads run in the pool
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for idx, result in zip(on_disk, executor.map(load, on_disk)):
+            results[idx] = result
 
-def search_id_for_experiment_acc(acc: str) -> str:
+    # misses go to NCBI, their concurrency is bounded by the caller's threads
+    for idx, result in enumerate(results):
+        if result is _NOT_IN_MEMORY:
+            results[idx] = _call_and_save(funct, cache_paths[idx], args_list[idx], {})
+    return results
+
+
+def search_id_for_experiment_acc(acc: str) -> NumericId:
     url = NCBI_SEARCH_BASE_URL + f"db=sra&term={acc}[Accession]&retmode=json&retmax=1"
     return _search_id_with(url, acc=acc, db="sra")
 
 
-def _search_id_with(url, acc, db) -> str:
-    response = requests.get(url)
-    assert response.status_code == 200
-    content = response.content
-    search_result = json.loads(content)
+def _search_id_with(url, acc, db) -> NumericId:
+    search_result = _get_json(url)
     if not search_result["esearchresult"]:
         raise ValueError(f"acc {acc} not found in the {db} database")
 
@@ -68,21 +346,21 @@ def _search_id_with(url, acc, db) -> str:
         raise RuntimeError(f"We expected just 1 id in idlist for acc: {acc}")
 
     id_ = search_result["esearchresult"]["idlist"][0]
-    if not id_.isdigit():
+    if not id_.isdecimal():
         raise RuntimeError(
             f"We expected an all digit id for acc {acc}, but we got: {id_}"
         )
 
-    return id_
+    return NumericId(id_)
 
 
-def search_id_for_biosample_acc(acc: str) -> str:
+def search_id_for_biosample_acc(acc: str) -> NumericId:
     db = "biosample"
     url = NCBI_SEARCH_BASE_URL + f"db={db}&term={acc}[Accession]&retmode=json&retmax=1"
     return _search_id_with(url, acc, db=db)
 
 
-def search_id_for_bioproject_acc(acc: str) -> str:
+def search_id_for_bioproject_acc(acc: str) -> NumericId:
     url = (
         NCBI_SEARCH_BASE_URL
         + f"db=bioproject&term={acc}[Accession]&retmode=json&retmax=1"
@@ -90,12 +368,9 @@ def search_id_for_bioproject_acc(acc: str) -> str:
     return _search_id_with(url, acc, db="bioproject")
 
 
-def fetch_bioproject_acc_for_experiment(id: str):
-    if not id.isdigit():
-        raise RuntimeError(f"We expected an all digit experiment id, but we got: {id}")
-
+def fetch_bioproject_acc_for_experiment(id: NumericId):
     url = NCBI_FETCH_BASE_URL + f"db=sra&id={id}"
-    response = requests.get(url)
+    response = _get(url)
     assert response.status_code == 200
     xml = response.content
     experiment_set = ET.fromstring(xml)
@@ -111,30 +386,27 @@ def fetch_bioproject_acc_for_experiment(id: str):
         raise RuntimeError(f"No bioproject acc found for experiment: {id}")
 
 
-def fetch_bioproject_info(id: str):
-    if not id.isdigit():
-        raise RuntimeError(f"We expected an all digit experiment id, but we got: {id}")
+def fetch_bioproject_info(id: NumericId):
     url = NCBI_FETCH_BASE_URL + f"db=bioproject&id={id}"
 
-    response = requests.get(url)
+    response = _get(url)
 
     if response.status_code != 200:
         raise RuntimeError(f"There was an error requesting the url: {url}")
 
     xml = response.content
     record_set = ET.fromstring(xml)
-    project = record_set.find("DocumentSummary").find("Project")
-    info = {}
-    info["acc"] = project.find("ProjectID").find("ArchiveID").attrib["accession"]
-    info["title"] = project.find("ProjectDescr").find("Title").text
-    info["description"] = project.find("ProjectDescr").find("Description").text
+    document_summary = record_set.find("DocumentSummary")
+    project = document_summary.find("Project")
+    info = _get_fields(project, _BIOPROJECT_FIELDS)
     try:
         target = (
             project.find("ProjectType").find("ProjectTypeSubmission").find("Target")
         )
     except AttributeError:
         target = None
-    if target:
+    # a Target without children counts as missing, as its truth value did
+    if target is not None and len(target):
         info["type"] = {
             "capture": target.attrib["capture"],
             "material": target.attrib["material"],
@@ -146,35 +418,19 @@ def fetch_bioproject_info(id: str):
         }
 
     try:
-        info["submission_last_update"] = (
-            record_set.find("DocumentSummary").find("Submission").attrib["last_update"]
-        )
+        info["submission_last_update"] = document_summary.find("Submission").attrib[
+            "last_update"
+        ]
     except KeyError:
         pass
     return info
 
 
-def ask_ncbi_for_biosample_ids_in_bioproject(bioproject_id: str) -> list[str]:
-    if bioproject_id.lower().startswith("prj"):
-        raise ValueError(
-            f"Use the numeric id, not the PRJXXXX accession: {bioproject_id}"
-        )
-    try:
-        int(bioproject_id)
-    except ValueError:
-        raise ValueError(
-            f"The id should be an str, but all numbers (e.g. 1025377), but it was: {bioproject_id}"
-        )
-
+def ask_ncbi_for_biosample_ids_in_bioproject(
+    bioproject_id: NumericId,
+) -> list[NumericId]:
     url = f"{NCBI_EUTILS_BASE_URL}elink.fcgi?dbfrom=bioproject&db=biosample&id={bioproject_id}&retmode=json"
-    response = requests.get(url)
-
-    if response.status_code != 200:
-        raise RuntimeError(f"Thre was a problem getting the URL: {url}")
-
-    jsons = response.content
-
-    search_result = json.loads(jsons)
+    search_result = _get_json(url)
 
     biosample_ids = set()
     for linkset in search_result["linksets"]:
@@ -183,20 +439,52 @@ def ask_ncbi_for_biosample_ids_in_bioproject(bioproject_id: str) -> list[str]:
     return sorted(biosample_ids)
 
 
-def fetch_biosample_info(biosample_id: str):
-    if biosample_id.lower().startswith("prj"):
-        raise ValueError(
-            f"Use the numeric id, not the SAMNXXXX accession: {biosample_id}"
-        )
-    try:
-        int(biosample_id)
-    except ValueError:
-        raise ValueError(
-            f"The id should be an str, but all numbers (e.g. 1025377), but it was: {biosample_id}"
+def ask_ncbi_for_biosample_ids_in_bioprojects(
+    bioproject_ids: list[NumericId],
+) -> dict[NumericId, list[NumericId]]:
+    bioproject_ids = list(bioproject_ids)
+
+    url = f"{NCBI_EUTILS_BASE_URL}elink.fcgi"
+    biosample_ids = {bioproject_id: set() for bioproject_id in bioproject_ids}
+    linked_ids = set()
+    for start in range(0, len(bioproject_ids), EFETCH_BATCH_SIZE):
+        batch = bioproject_ids[start : start + EFETCH_BATCH_SIZE]
+        # one id param per bioproject, so that each one gets its own linkset
+        data = [("dbfrom", "bioproject"), ("db", "biosample"), ("retmode", "json")]
+        data.extend(("id", bioproject_id) for bioproject_id in batch)
+        response = _post(url, data=data)
+        if response.status_code != 200:
+            raise RuntimeError(f"There was a problem linking bioproject ids: {batch}")
+        result = _parse_json(response.content)
+        if "ERROR" in result:
+            raise RuntimeError(
+                f"Error linking bioproject ids {batch}: {result['ERROR']}"
+            )
+        for linkset in result["linksets"]:
+            if "ERROR" in linkset:
+                raise RuntimeError(
+                    f"Error linking bioproject ids {linkset.get('ids')}: "
+                    f"{linkset['ERROR']}"
+                )
+            bioproject_id = linkset["ids"][0]
+            linked_ids.add(bioproject_id)
+            # a linkset without linksetdbs is a bioproject without biosamples
+            links = biosample_ids[bioproject_id]
+            for linksetdb in linkset.get("linksetdbs", []):
+                links.update(linksetdb["links"])
+    missing_ids = set(biosample_ids).difference(linked_ids)
+    if missing_ids:
+        raise RuntimeError(
+            f"No linkset found for bioproject ids: {sorted(missing_ids)}"
         )
+    return {
+        bioproject_id: sorted(links) for bioproject_id, links in biosample_ids.items()
+    }
 
+
+def fetch_biosample_info(biosample_id: NumericId):
     url = f"{NCBI_EUTILS_BASE_URL}efetch.fcgi?db=biosample&id={biosample_id}"
-    response = requests.get(url)
+    response = _get(url)
 
     if response.status_code != 200:
         raise RuntimeError(f"There was a problem getting the URL: {url}")
@@ -204,25 +492,30 @@ def fetch_biosample_info(biosample_id: str):
     xml = response.content
 
     biosample_set = ET.fromstring(xml)
-    biosample_xml = biosample_set.find("BioSample")
-    biosample = {}
-    biosample["biosampledb_id"] = biosample_xml.attrib["id"]
-    biosample["biosampledb_accession"] = biosample_xml.attrib["accession"]
-    biosample["publication_date"] = biosample_xml.attrib["publication_date"]
+    return _get_info_from_biosample(biosample_set.find("BioSample"))
+
+
+def fetch_biosample_info_batch(biosample_ids: list[NumericId]) -> dict[str, dict]:
+    biosample_ids = list(biosample_ids)
+
+    biosamples = {}
+    for xml in _fetch_in_batches("biosample", biosample_ids):
+        for biosample_xml in _iter_elements(xml, "BioSample"):
+            biosample = _get_info_from_biosample(biosample_xml)
+            biosamples[biosample["biosampledb_id"]] = biosample
+
+    missing_ids = set(biosample_ids).difference(biosamples)
+    if missing_ids:
+        raise RuntimeError(f"No biosample found for ids: {sorted(missing_ids)}")
+    return biosamples
+
+
+def _get_info_from_biosample(biosample_xml):
+    biosample = _get_fields(biosample_xml, _BIOSAMPLE_FIELDS)
     for id in biosample_xml.find("Ids").findall("Id"):
-        try:
-            id.attrib["db"]
-        except KeyError:
-            continue
-        if id.attrib["db"] == "SRA":
+        if id.get("db") == "SRA":
             biosample["sra_accession"] = id.text
 
-    description = biosample_xml.find("Description")
-    biosample["title"] = description.find("Title").text
-    organism = description.find("Organism")
-    biosample["organism_id"] = organism.attrib["taxonomy_id"]
-    biosample["organism_name"] = organism.attrib["taxonomy_name"]
-
     attributes = {}
     for attribute_xml in biosample_xml.find("Attributes"):
         attributes[attribute_xml.attrib["attribute_name"]] = attribute_xml.text
@@ -233,146 +526,91 @@ def fetch_biosample_info(biosample_id: str):
 
 def search_experiments_in_sra_with_biosample_accession(biosample_acc, cache_dir=None):
     url = f"{NCBI_EUTILS_BASE_URL}esearch.fcgi?db=sra&term={biosample_acc}[BioSample]&retmode=json"
-    response = requests.get(url)
-    assert response.status_code == 200
-    jsons = response.content
-    search_result = json.loads(jsons)
+    search_result = _get_json(url)
     ids = search_result["esearchresult"]["idlist"]
 
     return ids
 
 
-def fetch_experiment_info(experiment_id: str):
-    if experiment_id.lower().startswith("s"):
-        raise ValueError(
-            f"Use the numeric id, not the SRXXXXX accession: {experiment_id}"
-        )
-    try:
-        int(experiment_id)
-    except ValueError:
-        raise ValueError(
-            f"The id should be an str, but all numbers (e.g. 1025377), but it was: {experiment_id}"
-        )
-
+def fetch_experiment_info(experiment_id: NumericId):
     url = f"{NCBI_EUTILS_BASE_URL}efetch.fcgi?db=sra&id={experiment_id}"
-    response = requests.get(url)
+    response = _get(url)
     xml = response.content
-    experiment_package_set = ET.fromstring(xml)
-    experiment_packages = experiment_package_set.findall("EXPERIMENT_PACKAGE")
-    if not experiment_packages:
+    infos = [
+        _get_info_from_experiment_package(experiment_package, url)
+        for experiment_package in _iter_elements(xml, "EXPERIMENT_PACKAGE")
+    ]
+    if not infos:
         raise RuntimeError(f"No experiment package found: {url}")
-    elif len(experiment_packages) != 1:
+    elif len(infos) != 1:
         raise RuntimeError(f"We expected only one experiment package: {url}")
-    experiment_package = experiment_packages[0]
+    return infos[0]
+
+
+def fetch_experiment_info_batch(experiment_ids: list[NumericId]) -> list[dict]:
+    experiment_ids = list(experiment_ids)
+
+    url = f"{NCBI_EUTILS_BASE_URL}efetch.fcgi?db=sra"
+    infos = []
+    for xml in _fetch_in_batches("sra", experiment_ids):
+        infos.extend(
+            _get_info_from_experiment_package(experiment_package, url)
+            for experiment_package in _iter_elements(xml, "EXPERIMENT_PACKAGE")
+        )
+    if len(infos) != len(experiment_ids):
+        raise RuntimeError(
+            f"We expected {len(experiment_ids)} experiment packages, "
+            f"but we got {len(infos)}"
+        )
+    return infos
+
+
+def _iter_elements(xml, tag):
+    if isinstance(xml, bytes):
+        xml = io.BytesIO(xml)
+    events = ET.iterparse(xml, events=("start", "end"))
+    _, root = next(events)
+    for event, elem in events:
+        if event == "end" and elem.tag == tag:
+            yield elem
+            root.clear()
+
+
+def _get_info_from_experiment_package(experiment_package, url):
     experiments = experiment_package.findall("EXPERIMENT")
     if len(experiments) != 1:
         raise RuntimeError(f"We expected only one experiment: {url}")
     experiment = experiments[0]
 
-    info = {"acc": experiment.find("IDENTIFIERS").find("PRIMARY_ID").text}
-    info["study_acc"] = experiment.find("STUDY_REF").attrib["accession"]
-    info["design"] = {
-        "description": experiment.find("DESIGN").find("DESIGN_DESCRIPTION").text,
-        "sample": experiment.find("DESIGN")
-        .find("SAMPLE_DESCRIPTOR")
-        .attrib["accession"],
-        "library": {
-            "strategy": experiment.find("DESIGN")
-            .find("LIBRARY_DESCRIPTOR")
-            .find("LIBRARY_STRATEGY")
-            .text,
-            "source": experiment.find("DESIGN")
-            .find("LIBRARY_DESCRIPTOR")
-            .find("LIBRARY_SOURCE")
-            .text,
-            "selection": experiment.find("DESIGN")
-            .find("LIBRARY_DESCRIPTOR")
-            .find("LIBRARY_SELECTION")
-            .text,
-            "layout": experiment.find("DESIGN")
-            .find("LIBRARY_DESCRIPTOR")
-            .find("LIBRARY_LAYOUT")
-            .text,
-        },
-    }
-    platform = experiment.find("PLATFORM")
-    if platform.find("ILLUMINA"):
-        info["platform"] = {
-            "platform": "ilumina",
-            "instrument_model": platform.find("ILLUMINA").find("INSTRUMENT_MODEL").text,
-        }
-    elif platform.find("DNBSEQ"):
-        info["platform"] = {
-            "platform": "dnbseq",
-            "instrument_model": platform.find("DNBSEQ").find("INSTRUMENT_MODEL").text,
-        }
-    elif platform.find("OXFORD_NANOPORE"):
-        info["platform"] = {
-            "platform": "nanopore",
-            "instrument_model": platform.find("OXFORD_NANOPORE")
-            .find("INSTRUMENT_MODEL")
-            .text,
-        }
-    elif platform.find("PACBIO_SMRT"):
-        info["platform"] = {
-            "platform": "pacbio",
-            "instrument_model": platform.find("PACBIO_SMRT")
-            .find("INSTRUMENT_MODEL")
-            .text,
-        }
-    elif platform.find("BGISEQ"):
-        info["platform"] = {
-            "platform": "bgiseq",
-            "instrument_model": platform.find("BGISEQ").find("INSTRUMENT_MODEL").text,
-        }
-    elif platform.find("LS454"):
-        info["platform"] = {
-            "platform": "454",
-            "instrument_model": platform.find("LS454").find("INSTRUMENT_MODEL").text,
-        }
-    elif platform.find("ABI_SOLID"):
-        info["platform"] = {
-            "platform": "solid",
-            "instrument_model": platform.find("ABI_SOLID")
-            .find("INSTRUMENT_MODEL")
-            .text,
-        }
+    info = _get_fields(experiment, _EXPERIMENT_FIELDS)
+    design = experiment.find("DESIGN")
+    info["design"] = _get_fields(design, _DESIGN_FIELDS)
+    info["design"]["library"] = _get_fields(
+        design.find("LIBRARY_DESCRIPTOR"), _LIBRARY_FIELDS
+    )
+    for platform_xml in experiment.find("PLATFORM"):
+        if platform_xml.tag in _PLATFORM_NAMES:
+            break
     else:
         raise RuntimeError(f"Unknown platform for: {url}")
+    info["platform"] = {
+        "platform": _PLATFORM_NAMES[platform_xml.tag],
+        "instrument_model": platform_xml.find("INSTRUMENT_MODEL").text,
+    }
 
     info["organization"] = experiment_package.find("Organization").find("Name").text
-    try:
-        info["study"] = (
-            experiment_package.find("STUDY")
-            .find("DESCRIPTOR")
-            .find("STUDY_DESCRIPTION")
-            .text
-        )
-    except AttributeError:
-        info["study"] = (
-            experiment_package.find("STUDY").find("DESCRIPTOR").find("STUDY_TITLE").text
-        )
+    study_descriptor = experiment_package.find("STUDY").find("DESCRIPTOR")
+    study = study_descriptor.find("STUDY_DESCRIPTION")
+    if study is None:
+        study = study_descriptor.find("STUDY_TITLE")
+    info["study"] = study.text
 
     runs = []
-    run_set = experiment_package.find("RUN_SET")
-    for run in run_set.findall("RUN"):
-        run_info = {}
-        run_info["accession"] = run.attrib["accession"]
-        run_info["date"] = run.attrib["published"]
-        run_info["is_public"] = run.attrib["is_public"]
-
-        files = []
-        try:
-            sra_files = run.find("SRAFiles").findall("SRAFile")
-        except AttributeError:
-            sra_files = []
-        for file in sra_files:
-            file_info = {}
-            file_info["name"] = file.attrib["filename"]
-            file_info["md5"] = file.attrib["md5"]
-            file_info["s3_url"] = file.find("Alternatives").attrib["url"]
-            files.append(file_info)
-        run_info["files"] = files
+    for run in experiment_package.find("RUN_SET").findall("RUN"):
+        run_info = _get_fields(run, _RUN_FIELDS)
+        sra_files = run.find("SRAFiles")
+        sra_files = [] if sra_files is None else sra_files.findall("SRAFile")
+        run_info["files"] = [_get_fields(file, _SRA_FILE_FIELDS) for file in sra_files]
 
         runs.append(run_info)
     info["runs"] = runs
@@ -380,6 +618,103 @@ def fetch_experiment_info(experiment_id: str):
     return info
 
 
+def get_experiments_in_bioproject(
+    bioproject_acc, cache_dir, biosample_ids=None, project_id=None
+):
+    if biosample_ids is not None:
+        biosample_ids = [_validate_numeric(id_) for id_ in biosample_ids]
+    if project_id is not None:
+        project_id = _validate_numeric(project_id)
+    elif biosample_ids is None:
+        project_id = cache_call(
+            search_id_for_bioproject_acc,
+            args=(bioproject_acc,),
+            cache_dir=cache_dir,
+        )
+
+    if project_id is None:
+        # biosamples given without a bioproject to describe them
+        project_info = {"title": "", "description": ""}
+    elif biosample_ids is not None:
+        project_info = cache_call(
+            fetch_bioproject_info, args=(project_id,), cache_dir=cache_dir
+        )
+    else:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            project_info_future = executor.submit(
+                cache_call,
+                fetch_bioproject_info,
+                args=(project_id,),
+                cache_dir=cache_dir,
+            )
+            biosample_ids = cache_call(
+                ask_ncbi_for_biosample_ids_in_bioproject,
+                args=(project_id,),
+                cache_dir=cache_dir,
+            )
+            project_info = project_info_future.result()
+
+    biosamples = cache_call(
+        fetch_biosample_info_batch, args=(tuple(biosample_ids),), cache_dir=cache_dir
+    )
+
+    bioproject_fields = (
+        bioproject_acc,
+        project_info["title"],
+        project_info["description"],
+    )
+    biosample_experiment_ids = cache_call_many(
+        search_experiments_in_sra_with_biosample_accession,
+        cache_dir=cache_dir,
+        args_list=[
+            (biosamples[biosample_id]["biosampledb_accession"],)
+            for biosample_id in biosample_ids
+        ],
+    )
+    biosample_experiments = cache_call_many(
+        fetch_experiment_info_batch,
+        cache_dir=cache_dir,
+        args_list=[
+            (tuple(experiment_ids),) for experiment_ids in biosample_experiment_ids
+        ],
+    )
+
+    experiments = []
+    for biosample_id, experiments_in_biosample in zip(
+        biosample_ids, biosample_experiments
+    ):
+        biosample = biosamples[biosample_id]
+        biosample_fields = (
+            *bioproject_fields,
+            biosample["title"],
+            biosample["organism_name"],
+            biosample.get("attributes", {}).get("cultivar", ""),
+        )
+        for experiment in experiments_in_biosample:
+            first_run = experiment["runs"][0]
+            library = experiment["design"]["library"]
+
+            for run in experiment["runs"]:
+                print(run["accession"])
+
+            # in the EXPERIMENT_COLUMNS order
+            experiments.append(
+                (
+                    experiment["acc"],
+                    *biosample_fields,
+                    library["strategy"],
+                    library["source"],
+                    library["selection"],
+                    experiment["platform"]["instrument_model"],
+                    experiment["organization"],
+                    experiment["study"],
+                    first_run["date"],
+                    first_run["is_public"],
+                )
+            )
+    return experiments
+
+
 if __name__ == "__main__":
     # id_ = search_id_for_experiment_acc("SRX27341610")
     cache_dir = Path("__file__").absolute().parent / "cache"
@@ -608,66 +943,48 @@ if __name__ == "__main__":
         "SRP010718",
     ]
     biosample_ids_for_bioprojects = {"SRP010718": ["780126"]}
-    experiments = {}
-    for idx, bioproject_acc in enumerate(bioprojects):
+    experiments = []
+
+    bioprojects_to_look_up = [
+        bioproject_acc
+        for bioproject_acc in bioprojects
+        if bioproject_acc not in biosample_ids_for_bioprojects
+    ]
+    project_ids = cache_call_many(
+        search_id_for_bioproject_acc,
+        cache_dir=cache_dir,
+        args_list=[(bioproject_acc,) for bioproject_acc in bioprojects_to_look_up],
+    )
+    project_ids = dict(zip(bioprojects_to_look_up, project_ids))
+    biosample_ids_in_projects = cache_call(
+        ask_ncbi_for_biosample_ids_in_bioprojects,
+        args=(tuple(sorted(set(project_ids.values()))),),
+        cache_dir=cache_dir,
+    )
+
+    def get_experiments(bioproject_acc):
         if bioproject_acc in biosample_ids_for_bioprojects:
-            biosample_ids = biosample_ids_for_bioprojects[bioproject_acc]
-        else:
-            project_id = cache_call(
-                search_id_for_bioproject_acc,
-                args=(bioproject_acc,),
-                cache_dir=cache_dir,
-            )
-            project_info = cache_call(
-                fetch_bioproject_info, args=(project_id,), cache_dir=cache_dir
-            )
-            biosample_ids = cache_call(
-                ask_ncbi_for_biosample_ids_in_bioproject,
-                args=(project_id,),
+            return get_experiments_in_bioproject(
+                bioproject_acc,
                 cache_dir=cache_dir,
+                biosample_ids=biosample_ids_for_bioprojects[bioproject_acc],
             )
+        project_id = project_ids[bioproject_acc]
+        return get_experiments_in_bioproject(
+            bioproject_acc,
+            cache_dir=cache_dir,
+            biosample_ids=biosample_ids_in_projects[project_id],
+            project_id=project_id,
+        )
 
-        for biosample_id in biosample_ids:
-            biosample = cache_call(
-                fetch_biosample_info, args=(biosample_id,), cache_dir=cache_dir
-            )
-            experiment_ids = cache_call(
-                search_experiments_in_sra_with_biosample_accession,
-                args=(biosample["biosampledb_accession"],),
-                cache_dir=cache_dir,
-            )
-            for experiment_id in experiment_ids:
-                experiment = cache_call(
-                    fetch_experiment_info, args=(experiment_id,), cache_dir=cache_dir
-                )
-                date = [run["date"] for run in experiment["runs"]][0]
-                is_public = [run["date"] for run in experiment["runs"]][0]
-
-                for run in experiment["runs"]:
-                    print(run["accession"])
-
-                experiments[experiment["acc"]] = {
-                    "accession": experiment["acc"],
-                    "bioproject": bioproject_acc,
-                    "bioproject_title": project_info["title"],
-                    "bioproject_description": project_info["description"],
-                    "biosample_title": biosample["title"],
-                    "biosample_organism": biosample["organism_name"],
-                    "biosample_cultivar": biosample.get("attributes", {}).get(
-                        "cultivar", ""
-                    ),
-                    "library_strategy": experiment["design"]["library"]["strategy"],
-                    "library_source": experiment["design"]["library"]["source"],
-                    "library_selection": experiment["design"]["library"]["selection"],
-                    "platform": experiment["platform"]["instrument_model"],
-                    "organization": experiment["organization"],
-                    "study": experiment["study"],
-                    "date": date,
-                    "is_public": is_public,
-                }
+    with ThreadPoolExecutor(max_workers=NCBI_MAX_REQUESTS_PER_SECOND) as executor:
+        for bioproject_experiments in executor.map(get_experiments, bioprojects):
+            experiments.extend(bioproject_experiments)
 
     import pandas
 
-    experiments = pandas.DataFrame(experiments.values())
+    experiments = pandas.DataFrame.from_records(
+        experiments, columns=EXPERIMENT_COLUMNS
+    ).drop_duplicates(subset="accession", keep="last")
     print(experiments)
     experiments.to_excel("../../experiments.xlsx", index=False)
@@ -0,0 +1,26 @@
+import pytest
+
+from ncbi_utils.cache import load_cache, save_cache
+
+
+@pytest.mark.parametrize(
+    "value_",
+    [
+        b"<xml/>",
+        {"a": [1, 2.5, None, True, "x"]},
+        [{"a": 1}],
+        {1: "a"},
+        {"a": (1, 2)},
+        {"a": {1, 2}},
+        {"k": b"x"},
+        {"a": float("nan")},
+        {"a": 2**70},
+        ("a", 1),
+    ],
+)
+def test_cache_round_trip(tmp_path, value_):
+    cache_path = tmp_path / "value.pickle"
+    save_cache(value_, cache_path)
+    result = load_cache(cache_path)
+    assert type(result) is type(value_)
+    assert repr(result) == repr(value_)
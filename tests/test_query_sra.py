@@ -0,0 +1,131 @@
+import contextlib
+import io
+import json
+
+import pytest
+
+from ncbi_utils import query_sra
+
+
+class FakeResponse:
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+        self.raw = io.BytesIO(content)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.raw.close()
+
+
+@pytest.fixture(autouse=True)
+def empty_memory_cache():
+    query_sra._MEMORY_CACHE.clear()
+    yield
+    query_sra._MEMORY_CACHE.clear()
+
+
+def test_cache_call_many_keeps_order(tmp_path, monkeypatch):
+    calls = []
+
+    def double(value):
+        calls.append(value)
+        return value * 2
+
+    query_sra.cache_call_many(double, tmp_path, [("a",), ("b",), ("e",)])
+    query_sra._MEMORY_CACHE.clear()
+    query_sra.cache_call(double, tmp_path, args=("c",))
+
+    # "e" is listed, but removed before it is loaded
+    real_scandir = query_sra.os.scandir
+
+    def scandir_and_remove(path):
+        with real_scandir(path) as entries:
+            entries = list(entries)
+        (tmp_path / "double" / query_sra._hash_args(("e",), {})).unlink()
+        return contextlib.nullcontext(entries)
+
+    monkeypatch.setattr(query_sra.os, "scandir", scandir_and_remove)
+    calls.clear()
+    args_list = [("b",), ("c",), ("d",), ("e",), ("a",)]
+    results = query_sra.cache_call_many(double, tmp_path, args_list)
+
+    assert results == ["bb", "cc", "dd", "ee", "aa"]
+    assert calls == ["d", "e"]
+
+
+def test_hash_args_tells_apart_nesting_and_kwargs():
+    hashes = {
+        query_sra._hash_args(("a",), {}),
+        query_sra._hash_args((("a",),), {}),
+        query_sra._hash_args((), {"a": "a"}),
+        query_sra._hash_args(("a", "a"), {}),
+        query_sra._hash_args(("aa",), {}),
+        query_sra._hash_args((1,), {}),
+        query_sra._hash_args(("1",), {}),
+    }
+    assert len(hashes) == 7
+
+
+def _biosample_xml(id_):
+    return (
+        f'<BioSample id="{id_}" accession="SAMN{id_}" publication_date="2020">'
+        f'<Ids><Id db="SRA">SRS{id_}</Id></Ids>'
+        "<Description><Title>t</Title>"
+        '<Organism taxonomy_id="4081" taxonomy_name="Solanum lycopersicum"/>'
+        "</Description><Attributes/></BioSample>"
+    )
+
+
+def test_fetch_biosample_info_batch_raises_on_missing_ids(monkeypatch):
+    def post(url, data, stream=False):
+        xml = "".join(_biosample_xml(id_) for id_ in data["id"].split(",")[:-1])
+        return FakeResponse(f"<BioSampleSet>{xml}</BioSampleSet>".encode())
+
+    monkeypatch.setattr(query_sra, "_post", post)
+    with pytest.raises(RuntimeError, match="3"):
+        query_sra.fetch_biosample_info_batch(["1", "2", "3"])
+
+
+def test_iter_elements_over_a_stream():
+    xml = f"<BioSampleSet>{_biosample_xml('1')}{_biosample_xml('2')}</BioSampleSet>"
+    stream = io.BufferedReader(io.BytesIO(xml.encode()), buffer_size=16)
+    elements = query_sra._iter_elements(stream, "BioSample")
+    ids = [element.get("id") for element in elements]
+    assert ids == ["1", "2"]
+
+
+def _fake_elink(linksets, error=None):
+    def post(url, data):
+        result = {"linksets": linksets}
+        if error:
+            result["ERROR"] = error
+        return FakeResponse(json.dumps(result).encode())
+
+    return post
+
+
+def test_biosample_ids_in_bioprojects(monkeypatch):
+    linksets = [
+        {"ids": ["1"], "linksetdbs": [{"links": ["12", "11"]}]},
+        {"ids": ["2"]},
+    ]
+    monkeypatch.setattr(query_sra, "_post", _fake_elink(linksets))
+    result = query_sra.ask_ncbi_for_biosample_ids_in_bioprojects(["1", "2"])
+    assert result == {"1": ["11", "12"], "2": []}
+
+
+@pytest.mark.parametrize(
+    "linksets,error",
+    [
+        ([{"ids": ["1"]}], None),
+        ([{"ids": ["1"]}, {"ids": ["2"], "ERROR": "Invalid uid"}], None),
+        ([], "Invalid db name"),
+    ],
+)
+def test_biosample_ids_in_bioprojects_raises(monkeypatch, linksets, error):
+    monkeypatch.setattr(query_sra, "_post", _fake_elink(linksets, error))
+    with pytest.raises(RuntimeError):
+        query_sra.ask_ncbi_for_biosample_ids_in_bioprojects(["1", "2"])